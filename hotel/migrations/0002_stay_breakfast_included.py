@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-15 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stay',
+            name='breakfast_included',
+            field=models.BooleanField(blank=True, help_text='Whether breakfast is included, as last reported by the PMS', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-15 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0002_stay_breakfast_included'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='hotel',
+            name='pms_hotel_id',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+    ]
@@ -16,7 +16,7 @@ class Language(models.TextChoices):
 class Hotel(models.Model):
     name = models.CharField(max_length=200)
     city = models.CharField(max_length=200, blank=False, null=False)
-    pms_hotel_id = models.CharField(max_length=200)
+    pms_hotel_id = models.CharField(max_length=200, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -78,6 +78,11 @@ class Stay(models.Model):
     )
     checkin = models.DateField(blank=True, null=True)
     checkout = models.DateField(blank=True, null=True)
+    breakfast_included = models.BooleanField(
+        blank=True,
+        null=True,
+        help_text="Whether breakfast is included, as last reported by the PMS",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -1,12 +1,17 @@
 from abc import ABC, abstractmethod
-import inspect
-import sys
-import json
+import logging
+import msgspec
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.core.cache import cache
 from django.db import transaction
+from types import MappingProxyType
 from typing import Optional
 import phonenumbers
 from phonenumbers import NumberParseException
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from operator import attrgetter
 from .models import Language
 
 from hotel.external_api import (
@@ -18,6 +23,36 @@ from hotel.external_api import (
 
 from hotel.models import Stay, Guest, Hotel
 
+logger = logging.getLogger(__name__)
+
+# Upper bound on concurrent calls to the PMS API when fetching reservation details.
+MAX_API_WORKERS = 16
+# Number of rows sent per INSERT when upserting guests and stays.
+BULK_BATCH_SIZE = 1000
+# Fields copied from the PMS on every sync, the rest is managed by us.
+GUEST_SYNC_FIELDS = ["name", "language"]
+STAY_SYNC_FIELDS = ["status", "pms_guest_id", "checkin", "checkout", "guest", "breakfast_included"]
+# Number of reservations fetched and written together by the nightly update.
+NIGHTLY_BATCH_SIZE = 500
+# Number of (phone, region) validation results kept in memory.
+PHONE_CACHE_SIZE = 4096
+# Mapping between countries and languages, keyed by lowercase code.
+COUNTRY_LANGUAGE_MAPPING = MappingProxyType({
+	"nl": Language.DUTCH,
+	"de": Language.GERMAN,
+	"en-gb": Language.BRITISH_ENGLISH,
+	"es-es": Language.SPANISH_SPAIN,
+	"fr": Language.FRENCH,
+	"it": Language.ITALIAN,
+	"pt-pt": Language.PORTUGUESE_PORTUGAL,
+	"sv": Language.SWEDISH,
+	"da": Language.DANISH,
+})
+# Seconds a fetched reservation is served from the cache before asking the PMS again.
+RESERVATION_CACHE_TIMEOUT = 60
+# PMS implementations by class name, filled in by PMS.__init_subclass__.
+PMS_CLASSES = {}
+
 
 class PMS(ABC):
 	"""
@@ -27,6 +62,11 @@ class PMS(ABC):
 	def __init__(self):
 		pass
 
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		# Register every PMS implementation so get_pms can find it by name
+		PMS_CLASSES[cls.__name__] = cls
+
 	@property
 	def name(self):
 		longname = self.__class__.__name__
@@ -81,21 +121,57 @@ class PMS(ABC):
 		raise NotImplementedError
 
 
+class MewsReservation(msgspec.Struct, gc=False):
+	"""
+	Reservation as returned by the Mews API. Unknown fields are ignored.
+	The fields only hold scalars, so the structs can't form reference cycles and are
+	left out of garbage collector tracking.
+	"""
+	ReservationId: Optional[str] = None
+	HotelId: Optional[str] = None
+	GuestId: Optional[str] = None
+	Status: Optional[str] = None
+	CheckInDate: Optional[date] = None
+	CheckOutDate: Optional[date] = None
+	BreakfastIncluded: Optional[bool] = None
+
+
+class MewsGuest(msgspec.Struct, gc=False):
+	"""
+	Guest as returned by the Mews API. Unknown fields are ignored.
+	"""
+	GuestId: Optional[str] = None
+	Name: Optional[str] = None
+	Phone: Optional[str] = None
+	Country: Optional[str] = None
+
+
 class PMS_Mews(PMS):
 	def clean_webhook_payload(self, payload: str) -> dict:
 		try:
 			if not payload:
 				raise ValueError('Empty Payload')
-			payload_dict = json.loads(payload)
+			# orjson accepts the raw request bytes, no need to decode them to str first
+			payload_dict = orjson.loads(payload)
 			return payload_dict
 
-		except ValueError as value_error:
-			print(f"ValueError: {value_error}")
+		except orjson.JSONDecodeError as e:
+			logger.warning("Error decoding JSON payload: %s", e)
 			return {}
-		except json.JSONDecodeError as e:
-			print(f"Error decoding JSON payload: {e}")
+		except ValueError as value_error:
+			logger.warning("ValueError: %s", value_error)
 			return {}
 
+	def decode_api_response(self, response: str, response_type: type):
+		"""
+		Decode a Mews API response straight into the given struct type.
+		Returns None if the response is not valid for that type.
+		"""
+		try:
+			return msgspec.json.decode(response, type=response_type)
+		except msgspec.DecodeError as e:
+			logger.warning("Error decoding API response: %s", e)
+			return None
 
 	def handle_webhook(self, webhook_data: dict) -> bool:
 		hotel_id = webhook_data.get("HotelId")
@@ -105,27 +181,29 @@ class PMS_Mews(PMS):
 			hotel = Hotel.objects.get(pms_hotel_id=hotel_id)
 
 			hotel_events = webhook_data.get("Events")
+			reservation_ids = []
 			for event in hotel_events:
 				reservation_id = event['Value'].get('ReservationId')
 				if not reservation_id:
 					raise ValueError("Missing ReservationId in the webhook data.")
+				reservation_ids.append(reservation_id)
 
-				reservation_details = self.clean_webhook_payload(get_reservation_details(reservation_id))
-				guest_id = reservation_details.get("GuestId")
-				guest_details = self.clean_webhook_payload(get_guest_details(guest_id) if guest_id else "{}")
-
-				with transaction.atomic():
-					make_transaction(reservation_details, hotel, reservation_id, guest_details)
-			return True
+			# The webhook tells us these reservations changed, so skip the cache
+			details = self.bulk_get_reservation_details(reservation_ids, refresh=True)
+			reservations = [
+				(reservation_details, hotel, reservation_id, guest_details)
+				for reservation_id, (reservation_details, guest_details) in zip(reservation_ids, details)
+			]
+			return make_transaction(reservations)
 
 		except APIError as api_error:
-			print(f"API Error: {api_error}")
+			logger.error("API Error: %s", api_error)
 			return False
 		except ValueError as value_error:
-			print(f"ValueError: {value_error}")
+			logger.warning("ValueError: %s", value_error)
 			return False
 		except Exception as e:
-			print(f"An error occurred: {e}")
+			logger.exception("An error occurred: %s", e)
 			return False
 
 	def update_tomorrows_stays(self) -> bool:
@@ -135,116 +213,308 @@ class PMS_Mews(PMS):
 			tomorrow_date = tomorrow.date()
 
 			# Get all stays checking in tomorrow using the mock API
-			stays_to_update = self.clean_webhook_payload(
-				get_reservations_between_dates(tomorrow_date, tomorrow_date + timedelta(days=1))
+			raw_stays = self.decode_api_response(
+				get_reservations_between_dates(tomorrow_date, tomorrow_date + timedelta(days=1)),
+				list[msgspec.Raw],
 			)
+			if raw_stays is None:
+				return False
+
+			# Decode the reservations one at a time, so an invalid one only skips itself
+			all_valid = True
+			stays_to_update = []
+			for raw_stay in raw_stays:
+				stay_data = self.decode_api_response(raw_stay, MewsReservation)
+				if stay_data is None:
+					all_valid = False
+					continue
+				stays_to_update.append(stay_data)
+
+			# Look up every hotel referenced by the stays in a single query
+			hotel_ids = {stay_data.HotelId for stay_data in stays_to_update}
+			hotels = {hotel.pms_hotel_id: hotel for hotel in Hotel.objects.filter(pms_hotel_id__in=hotel_ids)}
+
+			valid_stays = []
 			for stay_data in stays_to_update:
 				# Extract relevant information from the stay_data
-				reservation_id = stay_data.get("ReservationId")
-				hotel_id = stay_data.get("HotelId")
+				reservation_id = stay_data.ReservationId
+				hotel = hotels.get(stay_data.HotelId)
 
-				if not (reservation_id and hotel_id):
-					print(f"Skipping stay with missing information: {stay_data}")
+				if not (reservation_id and hotel):
+					logger.warning("Skipping stay with missing information: %s", stay_data)
+					all_valid = False
 					continue
-				reservation_details = self.clean_webhook_payload(get_reservation_details(reservation_id))
-				guest_id = reservation_details.get("GuestId")
-				hotel = Hotel.objects.get(pms_hotel_id=hotel_id)
-				guest_details = self.clean_webhook_payload(get_guest_details(guest_id) if guest_id else "{}")
-				with transaction.atomic():
-					make_transaction(reservation_details, hotel, reservation_id, guest_details)
-			# Return True to indicate successful update of tomorrow's stays
-			return True
+				valid_stays.append((reservation_id, hotel))
+
+			# Fetch and write the stays in batches, so the fetched details and model instances
+			# are only held for one batch at a time. Reservations whose API calls fail are
+			# skipped inside their batch, and each batch is committed on its own
+			for start in range(0, len(valid_stays), NIGHTLY_BATCH_SIZE):
+				batch = valid_stays[start:start + NIGHTLY_BATCH_SIZE]
+				# Fetch all details of the batch up front so the API round-trips overlap
+				details = self.bulk_get_reservation_details([reservation_id for reservation_id, _ in batch])
+				reservations = [
+					(reservation_details, hotel, reservation_id, guest_details)
+					for (reservation_id, hotel), (reservation_details, guest_details) in zip(batch, details)
+				]
+				all_valid = make_transaction(reservations) and all_valid
+			# Return True to indicate every stay of tomorrow was updated
+			return all_valid
 
 		except APIError as api_error:
 			# Handle API errors (e.g., invalid data, failed API calls)
-			print(f"API Error: {api_error}")
+			logger.error("API Error: %s", api_error)
 			return False
 		except Exception as e:
 			# Handle other exceptions
-			print(f"An error occurred: {e}")
+			logger.exception("An error occurred: %s", e)
 			return False
 
+	def cached_reservation_details(self, reservation_id: str, refresh: bool = False) -> Optional[MewsReservation]:
+		"""
+		Return the reservation details, served from the cache when they were fetched
+		recently. Pass refresh=True to always ask the PMS, e.g. after it notified us
+		about a change. The fresh details are stored in the cache either way.
+		Returns None if the PMS call fails or returns invalid details.
+		"""
+		cache_key = f"resv:{reservation_id}"
+		if not refresh:
+			reservation_details = cache.get(cache_key)
+			if reservation_details is not None:
+				return reservation_details
+		try:
+			response = get_reservation_details(reservation_id)
+		except APIError as api_error:
+			logger.warning("API Error fetching reservation %s: %s", reservation_id, api_error)
+			return None
+		reservation_details = self.decode_api_response(response, MewsReservation)
+		if reservation_details is not None:
+			cache.set(cache_key, reservation_details, RESERVATION_CACHE_TIMEOUT)
+		return reservation_details
+
+	def fetch_guest_details(self, guest_id: str) -> Optional[MewsGuest]:
+		"""
+		Return the guest details, or None if the PMS call fails or returns invalid details.
+		"""
+		try:
+			response = get_guest_details(guest_id)
+		except APIError as api_error:
+			logger.warning("API Error fetching guest %s: %s", guest_id, api_error)
+			return None
+		return self.decode_api_response(response, MewsGuest)
+
+	def bulk_get_reservation_details(self, reservation_ids: list, refresh: bool = False) -> list:
+		"""
+		Fetch the reservation and guest details for many reservations concurrently.
+		Returns a list of (reservation_details, guest_details) tuples in the order of
+		reservation_ids. Details that could not be fetched are None, so a failed call
+		only affects its own reservation.
+		"""
+		if not reservation_ids:
+			return []
+		with ThreadPoolExecutor(max_workers=MAX_API_WORKERS) as executor:
+			# Fetch every distinct reservation and guest only once
+			reservation_futures = {
+				executor.submit(self.cached_reservation_details, reservation_id, refresh): reservation_id
+				for reservation_id in dict.fromkeys(reservation_ids)
+			}
+			reservations = {}
+			guest_futures = {}
+			try:
+				# Start each guest call as soon as its reservation arrives, instead of
+				# waiting for all reservations before fetching any guest
+				for future in as_completed(reservation_futures):
+					reservation_details = future.result()
+					reservations[reservation_futures[future]] = reservation_details
+					guest_id = reservation_details.GuestId if reservation_details else None
+					if guest_id and guest_id not in guest_futures:
+						guest_futures[guest_id] = executor.submit(self.fetch_guest_details, guest_id)
+				guests = {guest_id: future.result() for guest_id, future in guest_futures.items()}
+			except Exception:
+				# An unexpected error failed the batch, don't make the API calls that are still queued
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise
+
+		details = []
+		for reservation_id in reservation_ids:
+			reservation_details = reservations[reservation_id]
+			guest_id = reservation_details.GuestId if reservation_details else None
+			details.append((reservation_details, guests.get(guest_id)))
+		return details
+
 	def stay_has_breakfast(self, stay: Stay) -> Optional[bool]:
+		# Stays written by the webhook or the nightly update already know the answer
+		if stay.breakfast_included is not None:
+			return stay.breakfast_included
 		try:
-			reservation_details = self.clean_webhook_payload(get_reservation_details(stay.pms_reservation_id))
-			breakfast_included = reservation_details.get("BreakfastIncluded", False)
-			return breakfast_included
+			reservation_details = self.cached_reservation_details(stay.pms_reservation_id)
+			if reservation_details is None or reservation_details.BreakfastIncluded is None:
+				return None
+			# Store it, so older stays only need the API call once
+			stay.breakfast_included = reservation_details.BreakfastIncluded
+			stay.save(update_fields=["breakfast_included", "updated_at"])
+			return stay.breakfast_included
 		except Exception as e:
 			# Handle exceptions or return None if unable to determine
-			print(f"An error occurred while checking breakfast: {e}")
+			logger.warning("An error occurred while checking breakfast: %s", e)
 			return None
 
 
 def get_pms(name):
 	fullname = "PMS_" + name.capitalize()
-	# find all class names in this module
-	# from https://stackoverflow.com/questions/1796180/
-	current_module = sys.modules[__name__]
-	clsnames = [x[0] for x in inspect.getmembers(current_module, inspect.isclass)]
-
 	# if we have a PMS class for the given name, return an instance of it
-	return getattr(current_module, fullname)() if fullname in clsnames else False
+	pms_class = PMS_CLASSES.get(fullname)
+	return pms_class() if pms_class else False
 
 
-def validate_phone_number(phone_number):
+def validate_phone_number(phone_number, country_code=None):
+	"""
+	Validate the phone number and return it in E.164 format, so the same number
+	written in national or international format identifies the same Guest.
+	"""
 	if not phone_number:
 		raise ValueError("Missing Phone in the webhook data.")
+	# Parsing with a known region skips region inference and accepts national numbers
+	region = country_code.upper() if country_code else None
+	if region not in phonenumbers.SUPPORTED_REGIONS:
+		region = None
+	normalized_phone = normalize_phone_number(phone_number, region)
+	if normalized_phone is None:
+		raise ValueError("Invalid phone number format")
+	return normalized_phone
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def normalize_phone_number(phone_number, region):
+	# Returning guests come back with the same number every night, so results are cached
 	try:
-		parsed_phone = phonenumbers.parse(phone_number)
-		if not phonenumbers.is_valid_number(parsed_phone):
-			raise ValueError("Invalid phone number format")
+		parsed_phone = phonenumbers.parse(phone_number, region)
 	except NumberParseException:
-		raise ValueError("Invalid phone number format")
+		return None
+	# is_possible_number is a cheap length check, only run the full validation
+	# regexes on numbers that pass it
+	if not phonenumbers.is_possible_number(parsed_phone) or not phonenumbers.is_valid_number(parsed_phone):
+		return None
+	return phonenumbers.format_number(parsed_phone, phonenumbers.PhoneNumberFormat.E164)
 
 
-def make_transaction(reservation_details, hotel, reservation_id, guest_details):
-	# Update or create the Stay model
-	stay, _ = Stay.objects.update_or_create(
-		pms_reservation_id=reservation_id,
-		hotel=hotel,
-		defaults={
-			'pms_guest_id': reservation_details.get("GuestId"),
-			"checkin": reservation_details.get("CheckInDate"),
-			"checkout": reservation_details.get("CheckOutDate"),
-			"status": reservation_details.get("Status"),
-		}
-	)
-	# Validate phone number using phonenumbers library
-	phone_number = guest_details.get("Phone")
-	validate_phone_number(phone_number)
-	name = guest_details.get("Name")
-	# validate name 
-	if name is None or not name.strip():
-		raise ValueError("Guest name is missing or empty")
-	guest, _ = Guest.objects.update_or_create(
-		phone=guest_details.get("Phone"),
-		defaults={
-			"name": name,
-			"language": map_country_to_language(guest_details.get("Country")),
+def make_transaction(reservations):
+	"""
+	Upsert the guests and stays for a list of
+	(reservation_details, hotel, reservation_id, guest_details) tuples.
+	Reservations with invalid guest data are skipped. Returns False if any were skipped.
+	"""
+	guests = {}
+	stays = {}
+	all_valid = True
+	for reservation_details, hotel, reservation_id, guest_details in reservations:
+		try:
+			if reservation_details is None or guest_details is None:
+				raise ValueError("Missing reservation or guest details")
+			name = guest_details.Name
+			country = guest_details.Country
+			# Validate phone number using phonenumbers library
+			phone_number = validate_phone_number(guest_details.Phone, country)
+			# validate name
+			if name is None or not name.strip():
+				raise ValueError("Guest name is missing or empty")
+		except ValueError as value_error:
+			logger.warning("Skipping reservation %s: %s", reservation_id, value_error)
+			all_valid = False
+			continue
+
+		guests[phone_number] = Guest(
+			phone=phone_number,
+			name=name,
+			language=map_country_to_language(country),
+		)
+		stays[(hotel.pk, reservation_id)] = (phone_number, Stay(
+			pms_reservation_id=reservation_id,
+			hotel=hotel,
+			pms_guest_id=reservation_details.GuestId,
+			checkin=reservation_details.CheckInDate,
+			checkout=reservation_details.CheckOutDate,
+			status=reservation_details.Status,
+			breakfast_included=reservation_details.BreakfastIncluded,
+		))
+
+	if not stays:
+		return all_valid
+
+	# One transaction for all writes, opened only after the API calls and validation.
+	# The upserts lock rows in the order they are sent, so sort them by their unique key:
+	# concurrent webhooks touching the same rows then wait on each other instead of deadlocking.
+	with transaction.atomic():
+		# Most guests and stays are unchanged since the last sync, only write the ones that differ
+		saved_guests = Guest.objects.in_bulk(guests, field_name="phone")
+		changed_guests = [
+			guest for phone_number, guest in sorted(guests.items())
+			if has_changes(saved_guests.get(phone_number), guest, GUEST_SYNC_VALUES)
+		]
+		if changed_guests:
+			Guest.objects.bulk_create(
+				changed_guests,
+				update_conflicts=True,
+				unique_fields=["phone"],
+				update_fields=GUEST_SYNC_FIELDS + ["updated_at"],
+				batch_size=BULK_BATCH_SIZE,
+			)
+			# bulk_create does not set primary keys on upserted rows, so read them back
+			saved_guests.update(Guest.objects.in_bulk(
+				[guest.phone for guest in changed_guests], field_name="phone"
+			))
+		# Assign the guest to the stay
+		for phone_number, stay in stays.values():
+			stay.guest = saved_guests[phone_number]
+
+		saved_stays = {
+			(stay.hotel_id, stay.pms_reservation_id): stay
+			for stay in Stay.objects.filter(
+				hotel__in={hotel_pk for hotel_pk, _ in stays},
+				pms_reservation_id__in={reservation_id for _, reservation_id in stays},
+			)
 		}
-	)
-	# Assign the guest to the stay
-	stay.guest = guest
-	stay.save()
+		changed_stays = [
+			stay for key, (_, stay) in sorted(stays.items())
+			if has_changes(saved_stays.get(key), stay, STAY_SYNC_VALUES)
+		]
+		if changed_stays:
+			Stay.objects.bulk_create(
+				changed_stays,
+				update_conflicts=True,
+				unique_fields=["hotel", "pms_reservation_id"],
+				update_fields=STAY_SYNC_FIELDS + ["updated_at"],
+				batch_size=BULK_BATCH_SIZE,
+			)
+	return all_valid
+
+
+def sync_values_getter(model, fields):
+	"""
+	Build a getter returning the values of the given fields of a model instance as a
+	tuple. Field names are resolved to their attribute names once, not for every row.
+	"""
+	return attrgetter(*[model._meta.get_field(field).attname for field in fields])
+
+
+def has_changes(saved, instance, sync_values):
+	"""
+	Return True if the instance is not saved yet or differs from the saved row in any
+	of the fields read by sync_values.
+	"""
+	return saved is None or sync_values(saved) != sync_values(instance)
+
+
+GUEST_SYNC_VALUES = sync_values_getter(Guest, GUEST_SYNC_FIELDS)
+STAY_SYNC_VALUES = sync_values_getter(Stay, STAY_SYNC_FIELDS)
 
 
 def map_country_to_language(country_code):
-	# Mapping between countries and languages
 	if not country_code:
 		return 'No country code'
 	country_code = country_code.lower()
-	country_language_mapping = {
-		"nl": Language.DUTCH,
-		"de": Language.GERMAN,
-		"en-gb": Language.BRITISH_ENGLISH,
-		"es-es": Language.SPANISH_SPAIN,
-		"fr": Language.FRENCH,
-		"it": Language.ITALIAN,
-		"pt-pt": Language.PORTUGUESE_PORTUGAL,
-		"sv": Language.SWEDISH,
-		"da": Language.DANISH,
-	}
-	for key, value in country_language_mapping.items():
-		if key in country_code:
-			return value.label
-	return 'Unknown'
\ No newline at end of file
+	language = COUNTRY_LANGUAGE_MAPPING.get(country_code)
+	if language is None:
+		# Compound codes such as "nl-be" fall back to their prefix
+		language = COUNTRY_LANGUAGE_MAPPING.get(country_code.split("-", 1)[0])
+	return language.label if language is not None else 'Unknown'
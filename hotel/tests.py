@@ -1,3 +1,244 @@
+import json
+import time
+from datetime import date
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from hotel.external_api import APIError
+from hotel.models import Guest, Hotel, Stay
+from hotel.pms_systems import MewsGuest, MewsReservation, PMS_Mews, make_transaction
+
+HOTEL_ID = "851df8c8-90f2-4c4a-8e01-a4fc46b25178"
+
+
+class MakeTransactionTest(TestCase):
+    def setUp(self):
+        self.hotel = Hotel.objects.create(name="Hotel", city="Amsterdam", pms_hotel_id=HOTEL_ID)
+
+    def reservation(self, reservation_id="r1", status="booked", name="Jane Doe", phone="+491701234567"):
+        reservation_details = MewsReservation(
+            ReservationId=reservation_id,
+            HotelId=self.hotel.pms_hotel_id,
+            GuestId="g1",
+            Status=status,
+            CheckInDate=date(2030, 1, 1),
+            CheckOutDate=date(2030, 1, 3),
+            BreakfastIncluded=True,
+        )
+        guest_details = MewsGuest(GuestId="g1", Name=name, Phone=phone, Country="DE")
+        return (reservation_details, self.hotel, reservation_id, guest_details)
+
+    def test_creates_guest_and_stay(self):
+        self.assertTrue(make_transaction([self.reservation()]))
+
+        stay = Stay.objects.get(hotel=self.hotel, pms_reservation_id="r1")
+        self.assertEqual(stay.status, "booked")
+        self.assertEqual(stay.checkin, date(2030, 1, 1))
+        self.assertTrue(stay.breakfast_included)
+        self.assertEqual(stay.guest.phone, "+491701234567")
+        self.assertEqual(stay.guest.name, "Jane Doe")
+
+    def test_unchanged_resync_does_not_write(self):
+        make_transaction([self.reservation()])
+        stay = Stay.objects.get(pms_reservation_id="r1")
+        guest = Guest.objects.get(phone="+491701234567")
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(make_transaction([self.reservation()]))
+
+        writes = [
+            query["sql"] for query in queries.captured_queries
+            if query["sql"].startswith(("INSERT", "UPDATE"))
+        ]
+        self.assertEqual(writes, [])
+        self.assertEqual(Stay.objects.get(pk=stay.pk).updated_at, stay.updated_at)
+        self.assertEqual(Guest.objects.get(pk=guest.pk).updated_at, guest.updated_at)
+
+    def test_changes_are_written(self):
+        make_transaction([self.reservation()])
+
+        self.assertTrue(make_transaction([self.reservation(status="cancelled", name="Jane Smith")]))
+
+        stay = Stay.objects.get(pms_reservation_id="r1")
+        self.assertEqual(stay.status, "cancelled")
+        self.assertEqual(stay.guest.name, "Jane Smith")
+        self.assertEqual(Guest.objects.count(), 1)
+        self.assertEqual(Stay.objects.count(), 1)
+
+    def test_national_phone_number_is_stored_in_international_format(self):
+        make_transaction([self.reservation(phone="01701234567")])
+
+        self.assertEqual(Stay.objects.get(pms_reservation_id="r1").guest.phone, "+491701234567")
+
+    def test_invalid_phone_skips_reservation(self):
+        success = make_transaction([
+            self.reservation(reservation_id="r1", phone="123"),
+            self.reservation(reservation_id="r2"),
+        ])
+
+        self.assertFalse(success)
+        self.assertFalse(Stay.objects.filter(pms_reservation_id="r1").exists())
+        self.assertTrue(Stay.objects.filter(pms_reservation_id="r2").exists())
+
+
+def reservation_response(reservation_id, guest_id="g1", **fields):
+    reservation = {
+        "HotelId": HOTEL_ID,
+        "ReservationId": reservation_id,
+        "GuestId": guest_id,
+        "Status": "booked",
+        "CheckInDate": "2030-01-01",
+        "CheckOutDate": "2030-01-03",
+        "BreakfastIncluded": True,
+    }
+    reservation.update(fields)
+    return json.dumps(reservation)
+
+
+def guest_response(guest_id):
+    return json.dumps({"GuestId": guest_id, "Name": "Jane Doe", "Phone": "+491701234567", "Country": "DE"})
+
+
+class BulkGetReservationDetailsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.pms = PMS_Mews()
+
+    def test_results_are_in_request_order(self):
+        def get_reservation(reservation_id):
+            # Let later reservations finish first
+            time.sleep({"r1": 0.03, "r2": 0.02, "r3": 0.01}[reservation_id])
+            return reservation_response(reservation_id, guest_id="g" + reservation_id)
+
+        with patch("hotel.pms_systems.get_reservation_details", side_effect=get_reservation), \
+                patch("hotel.pms_systems.get_guest_details", side_effect=guest_response):
+            details = self.pms.bulk_get_reservation_details(["r1", "r2", "r3"])
+
+        self.assertEqual([reservation.ReservationId for reservation, _ in details], ["r1", "r2", "r3"])
+        self.assertEqual([guest.GuestId for _, guest in details], ["gr1", "gr2", "gr3"])
+
+    def test_each_reservation_and_guest_is_fetched_once(self):
+        with patch("hotel.pms_systems.get_reservation_details", side_effect=reservation_response) as get_reservation, \
+                patch("hotel.pms_systems.get_guest_details", side_effect=guest_response) as get_guest:
+            details = self.pms.bulk_get_reservation_details(["r1", "r2", "r1"])
+
+        self.assertEqual(len(details), 3)
+        self.assertEqual(sorted(call.args[0] for call in get_reservation.call_args_list), ["r1", "r2"])
+        get_guest.assert_called_once_with("g1")
+
+    def test_failed_api_call_only_skips_its_reservation(self):
+        def get_reservation(reservation_id):
+            if reservation_id == "r2":
+                raise APIError("The API is not available.")
+            return reservation_response(reservation_id, guest_id="g" + reservation_id)
+
+        def get_guest(guest_id):
+            if guest_id == "gr3":
+                raise APIError("The API is not available.")
+            return guest_response(guest_id)
+
+        with patch("hotel.pms_systems.get_reservation_details", side_effect=get_reservation), \
+                patch("hotel.pms_systems.get_guest_details", side_effect=get_guest):
+            details = self.pms.bulk_get_reservation_details(["r1", "r2", "r3"])
+
+        self.assertEqual(details[0][0].ReservationId, "r1")
+        self.assertEqual(details[0][1].GuestId, "gr1")
+        self.assertEqual(details[1], (None, None))
+        self.assertEqual(details[2][0].ReservationId, "r3")
+        self.assertIsNone(details[2][1])
+
+    def test_unexpected_error_cancels_queued_calls(self):
+        calls = []
+
+        def get_reservation(reservation_id):
+            calls.append(reservation_id)
+            if reservation_id == "r0":
+                raise RuntimeError("boom")
+            time.sleep(0.01)
+            return reservation_response(reservation_id)
+
+        reservation_ids = [f"r{i}" for i in range(200)]
+        with patch("hotel.pms_systems.get_reservation_details", side_effect=get_reservation), \
+                patch("hotel.pms_systems.get_guest_details", side_effect=guest_response):
+            with self.assertRaises(RuntimeError):
+                self.pms.bulk_get_reservation_details(reservation_ids)
+
+        self.assertLess(len(calls), len(reservation_ids))
+
+
+class UpdateTomorrowsStaysTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Hotel.objects.create(name="Hotel", city="Amsterdam", pms_hotel_id=HOTEL_ID)
+        self.pms = PMS_Mews()
+
+    def update_tomorrows_stays(self, reservations_response):
+        with patch("hotel.pms_systems.get_reservations_between_dates", return_value=reservations_response), \
+                patch("hotel.pms_systems.get_reservation_details", side_effect=reservation_response) as get_reservation, \
+                patch("hotel.pms_systems.get_guest_details", side_effect=guest_response):
+            success = self.pms.update_tomorrows_stays()
+        self.fetched_reservations = [call.args[0] for call in get_reservation.call_args_list]
+        return success
+
+    def test_updates_stays(self):
+        response = json.dumps([{"HotelId": HOTEL_ID, "ReservationId": "r1"}])
+
+        self.assertTrue(self.update_tomorrows_stays(response))
+        self.assertTrue(Stay.objects.filter(pms_reservation_id="r1").exists())
+
+    def test_unknown_hotel_is_skipped(self):
+        response = json.dumps([
+            {"HotelId": "unknown", "ReservationId": "r1"},
+            {"HotelId": HOTEL_ID, "ReservationId": "r2"},
+        ])
+
+        self.assertFalse(self.update_tomorrows_stays(response))
+        self.assertEqual(self.fetched_reservations, ["r2"])
+        self.assertEqual(list(Stay.objects.values_list("pms_reservation_id", flat=True)), ["r2"])
+
+    def test_invalid_reservation_only_skips_itself(self):
+        response = json.dumps([
+            {"HotelId": HOTEL_ID, "ReservationId": "r1", "CheckInDate": "not a date"},
+            {"HotelId": HOTEL_ID, "ReservationId": "r2", "BreakfastIncluded": None},
+        ])
+
+        self.assertFalse(self.update_tomorrows_stays(response))
+        self.assertEqual(list(Stay.objects.values_list("pms_reservation_id", flat=True)), ["r2"])
+
+    def test_invalid_response_fails(self):
+        self.assertFalse(self.update_tomorrows_stays(json.dumps({"Error": "not a list"})))
+        self.assertFalse(Stay.objects.exists())
+
+
+class StayHasBreakfastTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        hotel = Hotel.objects.create(name="Hotel", city="Amsterdam", pms_hotel_id=HOTEL_ID)
+        self.stay = Stay.objects.create(hotel=hotel, pms_reservation_id="r1")
+        self.pms = PMS_Mews()
+
+    def test_stored_value_is_used(self):
+        self.stay.breakfast_included = False
+        self.stay.save()
+
+        with patch("hotel.pms_systems.get_reservation_details") as get_reservation:
+            self.assertFalse(self.pms.stay_has_breakfast(self.stay))
+        get_reservation.assert_not_called()
+
+    def test_missing_value_is_fetched_and_saved(self):
+        with patch("hotel.pms_systems.get_reservation_details", side_effect=reservation_response) as get_reservation:
+            self.assertTrue(self.pms.stay_has_breakfast(self.stay))
+            self.assertTrue(self.pms.stay_has_breakfast(Stay.objects.get(pk=self.stay.pk)))
+
+        get_reservation.assert_called_once_with("r1")
+        self.assertTrue(Stay.objects.get(pk=self.stay.pk).breakfast_included)
+
+    def test_unknown_when_pms_omits_breakfast(self):
+        with patch("hotel.pms_systems.get_reservation_details", return_value=json.dumps({"ReservationId": "r1"})):
+            self.assertIsNone(self.pms.stay_has_breakfast(self.stay))
 
-# Create your tests here.
+        self.assertIsNone(Stay.objects.get(pk=self.stay.pk).breakfast_included)